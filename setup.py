@@ -2,14 +2,14 @@
 # Distributed under the Boost Software License, Version 1.0.
 # (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
 
-from setuptools import setup, find_namespace_packages
+from setuptools import setup
 import os
 
 VERSION = '0.4.0'
 
-print("TEST_VERSION:", os.getenv('TEST_VERSION'))
-if os.getenv('GHA_TEST_VERSION'):
-    VERSION = VERSION + '.dev' + os.getenv('GITHUB_RUN_NUMBER')
+RUN_NUMBER = os.getenv('GITHUB_RUN_NUMBER')
+if os.getenv('GHA_TEST_VERSION') and RUN_NUMBER:
+    VERSION = VERSION + '.dev' + RUN_NUMBER
 
 setup(
     # metadata
@@ -44,7 +44,7 @@ the Barbarian server at the [website](https://barbarian.bfgroup.xyz/).
     install_requires=['conan >= 1.41', 'sty >= 1.0.0rc2'],
     package_data={'barbarians': []},
     package_dir={"": "src"},
-    packages=find_namespace_packages(where="src"),
+    packages=["barbarians", "barbarians.hooks"],
     python_requires=">=3.8",
     entry_points={
         'console_scripts': [
@@ -3,17 +3,15 @@
 # (See accompanying file LICENSE.txt or http://www.boost.org/LICENSE_1_0.txt)
 
 from argparse import ArgumentParser, Action
-from os import environ, getcwd, chdir, listdir
-from shutil import rmtree, copytree, copy
-from subprocess import run, PIPE, CalledProcessError
-import hashlib
+from functools import cached_property, lru_cache
+from os import environ, getcwd, chdir
+from pathlib import Path
+from subprocess import run, Popen, PIPE, CalledProcessError
 import json
 import os.path
-import tarfile
-import datetime
-import yaml
-from conans import tools
-import conans.client.conan_api
+import re
+import sys
+import time
 from sty import fg
 from importlib.metadata import version
 
@@ -24,104 +22,175 @@ class UsageError(RuntimeError):
         self.reason = reason
 
 
+def _md5_path(path):
+    # Hash in fixed size blocks, reusing one buffer, to keep memory flat
+    # regardless of the file size. Newer Pythons do that for us.
+    import hashlib
+    if hasattr(hashlib, "file_digest"):
+        with open(path, "rb") as f:
+            return hashlib.file_digest(f, "md5").hexdigest()
+    h = hashlib.md5()
+    buffer = memoryview(bytearray(1 << 20))
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            h.update(buffer[:n])
+    return h.hexdigest()
+
+
+def _link_or_copy(src, dst, *, follow_symlinks=True):
+    # Hard link the file when possible, falling back to copying it when
+    # not, for example across file systems.
+    from shutil import copy
+    try:
+        os.link(src, dst, follow_symlinks=follow_symlinks)
+    except OSError:
+        copy(src, dst, follow_symlinks=follow_symlinks)
+
+
+def _write_json(path, data):
+    # Serialize compactly up front so the file is written in one go. And
+    # write it to the side first so that readers never see a partial file.
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(json.dumps(data, separators=(',', ':')).encode("utf-8"))
+    os.replace(tmp_path, path)
+
+
+class _HashingWriter(object):
+    # File object wrapper that updates a hash with everything written through
+    # it, so that generated files don't need to be read back to digest them.
+
+    def __init__(self, fp, h):
+        self.fp = fp
+        self.h = h
+
+    def write(self, b):
+        self.h.update(b)
+        return self.fp.write(b)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def _make_tgz(path, members):
+    # Write a gzipped tar of the (name, arcname) members and return its MD5.
+    # The stream is flushed, and member data copied, in large blocks instead
+    # of the default 10 KiB tar records and 16 KiB copies to cut down on the
+    # per write overhead. When available an external pigz, or gzip, does the
+    # fast compression of the tar stream while we hash its output. Like
+    # Conan, times and owners are left out so that the archive only depends
+    # on the contents.
+    import hashlib
+    import tarfile
+    from gzip import GzipFile
+    from shutil import copyfileobj, which
+    from threading import Thread
+
+    def reset_info(tarinfo):
+        tarinfo.mtime = 0
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ""
+        return tarinfo
+
+    def add_members(fileobj):
+        with tarfile.open(path, 'w|', fileobj=fileobj,
+                          bufsize=1 << 20, copybufsize=1 << 20) as tar:
+            for name, arcname in members:
+                tar.add(name, arcname, filter=reset_info)
+
+    h = hashlib.md5()
+    gzip = which("pigz") or which("gzip")
+    with open(path, "wb") as f:
+        out = _HashingWriter(f, h)
+        if not gzip:
+            with GzipFile(mode="wb", fileobj=out, compresslevel=1, mtime=0) as gz:
+                add_members(gz)
+            return h.hexdigest()
+        errors = []
+
+        def read_output():
+            # A failure to write out the archive is kept, to raise in place
+            # of a digest. And gzip is stopped, as nothing is going to read
+            # its output any more, so that feeding it fails instead of
+            # blocking forever.
+            try:
+                copyfileobj(proc.stdout, out, 1 << 20)
+            except BaseException as error:
+                errors.append(error)
+                proc.kill()
+                proc.stdout.close()
+
+        with Popen([gzip, "-1", "-n", "-c"], stdin=PIPE, stdout=PIPE) as proc:
+            reader = Thread(target=read_output)
+            reader.start()
+            try:
+                try:
+                    add_members(proc.stdin)
+                finally:
+                    proc.stdin.close()
+            finally:
+                reader.join()
+                if errors:
+                    raise errors[0]
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, proc.args)
+    return h.hexdigest()
+
+
+def _revision_matches(export_dir, revision_dir):
+    # Whether the uploaded revision dir has all the files it needs, and the
+    # files of the export have the same sizes there.
+    files_dir = os.path.join(revision_dir, "files")
+    try:
+        for name in ("snapshot.json", "files.json"):
+            os.stat(os.path.join(revision_dir, name))
+        for name in ("conan_export.tgz", "conan_sources.tgz"):
+            os.stat(os.path.join(files_dir, name))
+        with os.scandir(export_dir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    return False
+                if entry.stat().st_size != os.stat(
+                        os.path.join(files_dir, entry.name)).st_size:
+                    return False
+    except OSError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def _inspect_name_and_version(conan_api, recipe_dir, mtime_ns):
+    # Inspecting loads, and runs, the recipe which is slow. The results are
+    # kept for as long as the recipe file doesn't change, going by its mtime.
+    recipe_props = conan_api.inspect(recipe_dir, ['name', 'version'])
+    return recipe_props['name'], recipe_props['version']
+
+
+# Project root dirs found so far, keyed by the dir the search started in.
+_root_dirs = {}
+
+# Conan APIs set up so far, keyed by the root dir and remote they use.
+_conan_apis = {}
+
+
 class Barbarian(object):
-    def __init__(self):
-        ap = ArgumentParser("barbarian")
-
-        # General options..
-        ap.add_argument(
-            "--version",
-            help="Show the installed version.",
-            action="version",
-            version='%(prog)s ' + (version('barbarian')))
-        ap.add_argument(
-            "--remote",
-            help="The remote Barbarian repo to use specified as `<URL>@<NAME>."
-            + " Defaults to `https://barbarian.bfgroup.xyz/github@barbarian-github`.",
-            default="https://barbarian.bfgroup.xyz/github@barbarian-github"
-        )
-
-        # Sub-commands..
-        ap_sub = ap.add_subparsers(dest="command")
-
-        # Export command..
-        ap_export = ap_sub.add_parser(
-            "export",
-            help="Copies the recipe (conanfile.py & associated files) to local repo cache."
-        )
-        ap_export.add_argument(
-            "path",
-            help="Path to a folder containing a conanfile.py or to a recipe file e.g., my_folder/conanfile.py")
-        ap_export.add_argument(
-            "reference",
-            help="Pkg/version@user/channel"
-        )
-
-        # Upload command..
-        ap_upload = ap_sub.add_parser(
-            "upload",
-            help="Copies the current exported recipe to the local publish location."
-        )
-        ap_upload.add_argument(
-            "reference",
-            help="Pkg/version@user/channel"
-        )
-
-        # Upload branch..
-        ap_branch = ap_sub.add_parser(
-            "branch",
-            help="Create, if needed, the 'barbarian' branch for uploading exported recipes to.")
-        ap_branch.add_argument(
-            "action",
-            help="What action to apply to the upload branch.",
-            choices=['create', 'push']
-        )
-
-        # Create new recipe and/or other support files.
-        ap_new = ap_sub.add_parser(
-            "new",
-            help="Creates a new package recipe template and/or support files.")
-        ap_new.add_argument(
-            "reference",
-            help="name/version@user/channel")
-        ap_new.add_argument(
-            "--overwrite",
-            help="Overwrite existing files, if present, with new files.",
-            action="store_true")
-        ap_new.add_argument(
-            "--recipe",
-            help="The style of package recipe to generate, and flag to generate recipe.",
-            choices=['standalone', 'collection'],
-            action=ChoiceArgAction)
-        ap_new.add_argument(
-            "--header-only",
-            help="Create a header only package recipe.",
-            action="store_true")
-        ap_new.add_argument(
-            "--ci",
-            help="Create setup, i.e. scripts, for testing in CI for the given service.",
-            choices=["github"],
-            action=ChoiceArgAction)
-
-        self.args = ap.parse_args()
+    def __init__(self, args):
+        self.args = args
 
         # Synthesize some info from general arguments..
         self.args.remote_url = self.args.remote.split('@')[0]
         self.args.remote_name = self.args.remote.split('@')[1]
 
-        if self.args.command:
-            if hasattr(self, "command_"+self.args.command):
-                try:
-                    getattr(self, "command_"+self.args.command)(self.args)
-                except UsageError as error:
-                    print(fg.red + error.reason + fg.rs)
-                    exit(1)
-
-    def exec(self, command, input=None, capture_output=False, env={}):
+    def exec(self, command, input=None, capture_output=False, env=None):
         try:
-            input = input.encode() if input else None
-            e = environ.copy()
-            e.update(env)
+            # Input is text when capturing output as text, bytes otherwise.
+            if input is not None and not capture_output:
+                input = input.encode()
+            # Programs inherit our environment as is, unless adding to it.
+            e = {**environ, **env} if env else None
             result = run(
                 command,
                 env=e,
@@ -137,219 +206,223 @@ Failed to find a "{0}" program. Using Barbarian requires the "{0}" program. \
 
     # Root dir, calculated from recipe dir.
 
-    _root_dir = None
-
-    @property
+    @cached_property
     def root_dir(self):
-        return self._root_dir
-
-    @root_dir.setter
-    def root_dir(self, args):
-        self.recipe_dir = args
-        if not self._root_dir:
-            dir = self.recipe_dir if self.recipe_dir else getcwd()
-            while not os.path.exists(os.path.join(dir, ".git")):
-                parent = os.path.dirname(dir)
-                if parent == dir:
+        dir = self.recipe_dir if self.recipe_dir else getcwd()
+        # Search results are shared by all instances, as they don't change
+        # during a run.
+        root_dir = _root_dirs.get(dir)
+        if not root_dir:
+            # Ask git for the top level dir, which is a single call instead
+            # of probing each parent dir.
+            try:
+                root_dir = os.path.normpath(self.exec(
+                    ["git", "-C", dir if os.path.isdir(dir) else os.path.dirname(dir),
+                     "rev-parse", "--show-toplevel"],
+                    capture_output=True).stdout.strip())
+            except (CalledProcessError, UsageError):
+                start = Path(dir)
+                for parent in (start, *start.parents):
+                    if (parent / ".git").exists():
+                        root_dir = str(parent)
+                        break
+                else:
                     raise UsageError('''[ERROR] \
 Failed to find a git repo for the project. Using Barbarian requires \
 a git repo to be initialized, and linked to a remote, ahead of time.\
 ''')
-                dir = parent
-            self._root_dir = dir
-            print("[INFO] root_dir =", self._root_dir, flush=True)
+            _root_dirs[dir] = root_dir
+            # The dirs between here and the root share it, so remember them
+            # too for later searches starting in them.
+            start, root = Path(dir), Path(root_dir)
+            if root in start.parents:
+                for parent in start.parents:
+                    _root_dirs[str(parent)] = root_dir
+                    if parent == root:
+                        break
+        print("[INFO] root_dir =", root_dir, flush=True)
+        return root_dir
 
     # Recipe dir, calculated from "path" arg.
 
-    _recipe_dir = None
-
-    @property
+    @cached_property
     def recipe_dir(self):
-        return self._recipe_dir
-
-    @recipe_dir.setter
-    def recipe_dir(self, args):
-        if not self._recipe_dir and hasattr(args, "path"):
-            self._recipe_dir = os.path.abspath(args.path)
-            # print("[INFO] recipe_dir =", self._recipe_dir, flush=True)
+        if hasattr(self.args, "path"):
+            # print("[INFO] recipe_dir =", os.path.abspath(self.args.path), flush=True)
+            return os.path.abspath(self.args.path)
+        return None
 
     # Recipe name and version, as a list, calculated from conan inspection "reference" arg.
 
-    _recipe_name_and_version = None
-
-    @property
+    @cached_property
     def recipe_name_and_version(self):
-        return self._recipe_name_and_version
-
-    @recipe_name_and_version.setter
-    def recipe_name_and_version(self, args):
-        self.recipe_dir = args
-        self.root_dir = args
-        if not self._recipe_name_and_version:
-            recipe_nv = args.reference.split('@', 1)[0].split('/')
-            if self.recipe_dir:
-                recipe_props = self.conan_api.inspect(
-                    self.recipe_dir,
-                    ['name', 'version'])
-                recipe_n = recipe_props['name']
-                recipe_v = recipe_props['version']
-            if recipe_nv:
-                if len(recipe_nv) == 1:
-                    recipe_v = recipe_nv[0]
-                if len(recipe_nv) == 2:
-                    recipe_n = recipe_nv[0]
-                    recipe_v = recipe_nv[1]
-            self._recipe_name_and_version = [recipe_n, recipe_v]
-            # print("[INFO] recipe_name_and_version =",
-            #       self._recipe_name_and_version, flush=True)
+        recipe_nv = self.args.reference.split('@', 1)[0].split('/')
+        # The reference already names the recipe, no need to inspect it.
+        if len(recipe_nv) == 2 and recipe_nv[0] and recipe_nv[1]:
+            return recipe_nv
+        if self.recipe_dir:
+            conanfile = self.recipe_dir
+            if os.path.isdir(conanfile):
+                conanfile = os.path.join(conanfile, "conanfile.py")
+            try:
+                mtime_ns = os.stat(conanfile).st_mtime_ns
+            except OSError:
+                mtime_ns = None
+            recipe_n, recipe_v = _inspect_name_and_version(
+                self.conan_api, self.recipe_dir, mtime_ns)
+        if recipe_nv:
+            if len(recipe_nv) == 1:
+                recipe_v = recipe_nv[0]
+            if len(recipe_nv) == 2:
+                recipe_n = recipe_nv[0]
+                recipe_v = recipe_nv[1]
+        # print("[INFO] recipe_name_and_version =",
+        #       [recipe_n, recipe_v], flush=True)
+        return [recipe_n, recipe_v]
 
     # Recipe data dir where the export puts information. This is locally
     # controlled to be relative to the root dir. And calculated from root dir
     # and "self.recipe_name_and_version".
 
-    _recipe_data_dir = None
-
-    @property
+    @cached_property
     def recipe_data_dir(self):
-        return self._recipe_data_dir
-
-    @recipe_data_dir.setter
-    def recipe_data_dir(self, args):
-        self.root_dir = args
-        self.recipe_name_and_version = args
-        if not self._recipe_data_dir:
-            self._recipe_data_dir = os.path.join(
-                self.root_dir, ".conan", "data", self.recipe_name_and_version[0], self.recipe_name_and_version[1])
-            # print("[INFO] recipe_data_dir =", self._recipe_data_dir, flush=True)
-
-    _recipe_user_and_channel = None
+        return os.path.join(
+            self.root_dir, ".conan", "data", *self.recipe_name_and_version)
 
     # Recipe user and channel, calculated from "reference" arg.
 
-    @property
+    @cached_property
     def recipe_user_and_channel(self):
-        return self._recipe_user_and_channel
-
-    @recipe_user_and_channel.setter
-    def recipe_user_and_channel(self, args):
-        if not self._recipe_user_and_channel:
-            recipe_uc = args.reference.split('@', 1)[1].split('/')
-            recipe_u = recipe_uc[0] if recipe_uc and len(
-                recipe_uc) > 0 and len(recipe_uc[0]) > 0 else '_'
-            recipe_c = recipe_uc[1] if recipe_uc and len(
-                recipe_uc) > 1 and len(recipe_uc[1]) > 0 else '_'
-            self._recipe_user_and_channel = [recipe_u, recipe_c]
-            # print("[INFO] recipe_user_and_channel =", self._recipe_user_and_channel, flush=True)
+        # Missing, or empty, user and channel default to "_".
+        recipe_uc = self.args.reference.partition('@')[2].split('/') + ['', '']
+        recipe_u = recipe_uc[0] or '_'
+        recipe_c = recipe_uc[1] or '_'
+        # print("[INFO] recipe_user_and_channel =", [recipe_u, recipe_c], flush=True)
+        return [recipe_u, recipe_c]
 
     # Recipe export dir, where conan puts the exported recipe data, calculated
     # from "self.recipe_data_dir" and "self.recipe_user_and_channel".
 
-    _recipe_export_dir = None
-
-    @property
+    @cached_property
     def recipe_export_dir(self):
-        return self._recipe_export_dir
-
-    @recipe_export_dir.setter
-    def recipe_export_dir(self, args):
-        self.recipe_data_dir = args
-        self.recipe_user_and_channel = args
-        if not self._recipe_export_dir:
-            self._recipe_export_dir = os.path.join(
-                self.recipe_data_dir, *self.recipe_user_and_channel)
-            # print("[INFO] recipe_export_dir =", self._recipe_export_dir, flush=True)
+        return os.path.join(
+            self.recipe_data_dir, *self.recipe_user_and_channel)
 
     # Recipe publish dir, is where we create the published/uploaded recipe
     # data. Calculated from "self.root_dir" and "self.recipe_name_and_version".
 
-    _recipe_publish_dir = None
-
-    @property
+    @cached_property
     def recipe_publish_dir(self):
-        return self._recipe_publish_dir
-
-    @recipe_publish_dir.setter
-    def recipe_publish_dir(self, args):
-        self.root_dir = args
-        self.recipe_name_and_version = args
-        if not self._recipe_publish_dir:
-            self._recipe_publish_dir = os.path.join(
-                self.root_dir,
-                ".barbarian_upload",
-                *self.recipe_name_and_version)
-            # print("[INFO] recipe_publish_dir =", self._recipe_publish_dir, flush=True)
+        return os.path.join(
+            self.root_dir,
+            ".barbarian_upload",
+            *self.recipe_name_and_version)
 
     # Recipe exported revision, which is the revision in the generated export
     # data. Uses "self.recipe_export_dir".
 
-    _recipe_exported_revision = None
-
-    @property
+    @cached_property
     def recipe_exported_revision(self):
-        return self._recipe_exported_revision
-
-    @recipe_exported_revision.setter
-    def recipe_exported_revision(self, args):
-        self.recipe_export_dir = args
-        if not self._recipe_exported_revision:
-            with open(os.path.join(self.recipe_export_dir, "metadata.json"), "r") as f:
-                j = json.loads(f.read())
-                self._recipe_exported_revision = j['recipe']['revision']
-            # print("[INFO] recipe_exported_revision =", self._recipe_exported_revision, flush=True)
+        with open(os.path.join(self.recipe_export_dir, "metadata.json"), "rb") as f:
+            j = json.load(f)
+            return j['recipe']['revision']
 
     # Recipe revision specific publish dir.
 
-    _recipe_revision_pub_dir = None
-
-    @property
+    @cached_property
     def recipe_revision_pub_dir(self):
-        return self._recipe_revision_pub_dir
-
-    @recipe_revision_pub_dir.setter
-    def recipe_revision_pub_dir(self, args):
-        self.recipe_publish_dir = args
-        self.recipe_exported_revision = args
-        if not self._recipe_revision_pub_dir:
-            self._recipe_revision_pub_dir = os.path.join(
-                self.recipe_publish_dir, self.recipe_exported_revision)
-            # print("[INFO] recipe_revision_pub_dir =", self._recipe_revision_pub_dir, flush=True)
+        return os.path.join(
+            self.recipe_publish_dir, self.recipe_exported_revision)
 
     # Utilities..
 
-    _conan_api: conans.client.conan_api.Conan = None
-
-    @property
+    @cached_property
     def conan_api(self):
-        if not self._conan_api:
-            self._conan_api = conans.client.conan_api.Conan(
-                cache_folder=os.path.join(self.root_dir, '.conan'))
-            # Create local conan config, if needed.
-            self._conan_api.config_init()
-            # Barbarian only works with recipe revisions.
-            self._conan_api.config_set("general.revisions_enabled", "True")
-            # Install hooks for manipulating and checking packages.
-            hooks_dir_src = os.path.join(os.path.dirname(
-                os.path.abspath(__file__)), "hooks")
-            hooks_dir_dst = os.path.join(self.root_dir, '.conan', 'hooks')
-            # Need to make sure the hooks dst dir exists to copy into.
-            if not os.path.exists(hooks_dir_dst):
-                os.mkdir(hooks_dir_dst)
-            # Copy all the hooks we have so we can register them as needed.
-            for name in os.listdir(hooks_dir_src):
-                if name.endswith('.py'):
-                    copy(os.path.join(hooks_dir_src, name),
-                         os.path.join(hooks_dir_dst, name))
-            # Add the Barbarian remote so we can find dependencies.
-            self.conan_api.remote_add(
-                self.args.remote_name,
-                self.args.remote_url,
-                force=True)
-        return self._conan_api
+        # Setting up the API, and installing the hooks, is done once for all
+        # the instances using the same cache and remote, e.g. in a batch.
+        key = (self.root_dir, self.args.remote_name, self.args.remote_url)
+        conan_api = _conan_apis.get(key)
+        if conan_api:
+            return conan_api
+        # Loading Conan is costly, only do it for commands that need it.
+        import conans.client.conan_api
+        from shutil import copy
+        conan_api = conans.client.conan_api.Conan(
+            cache_folder=os.path.join(self.root_dir, '.conan'))
+        # Create local conan config, if needed.
+        conan_api.config_init()
+        # Barbarian only works with recipe revisions.
+        conan_api.config_set("general.revisions_enabled", "True")
+        # Install hooks for manipulating and checking packages.
+        hooks_dir_src = os.path.join(os.path.dirname(
+            os.path.abspath(__file__)), "hooks")
+        hooks_dir_dst = os.path.join(self.root_dir, '.conan', 'hooks')
+        # Need to make sure the hooks dst dir exists to copy into.
+        if not os.path.exists(hooks_dir_dst):
+            os.mkdir(hooks_dir_dst)
+        # Copy all the hooks we have so we can register them as needed.
+        with os.scandir(hooks_dir_src) as hooks:
+            for hook in hooks:
+                if hook.name.endswith('.py') and hook.is_file():
+                    copy(hook.path, os.path.join(hooks_dir_dst, hook.name))
+        # Add the Barbarian remote so we can find dependencies.
+        conan_api.remote_add(
+            self.args.remote_name,
+            self.args.remote_url,
+            force=True)
+        _conan_apis[key] = conan_api
+        return conan_api
+
+    # Local branches, listed once and refreshed after creating branches.
+
+    _branches = None
 
     def have_branch(self, branch):
-        branch_list = self.exec(
-            ["git", "branch", "--list", branch], capture_output=True).stdout.strip("\n\t *+")
-        return branch_list == branch
+        if self._branches is None:
+            self._branches = self.read_branches()
+        if self._branches is None:
+            self._branches = set(self.exec(
+                ["git", "for-each-ref", "--format=%(refname:lstrip=2)", "refs/heads/"],
+                capture_output=True).stdout.splitlines())
+        return branch in self._branches
+
+    def read_branches(self):
+        # Read the local branch names directly from the git dir, which avoids
+        # running git. Returns None when the repo layout isn't one we know to
+        # read, i.e. not plain loose and packed refs.
+        git_dir = os.path.join(self.root_dir, ".git")
+        try:
+            # Worktrees, and submodules, point to their git dir. And worktrees
+            # share the refs of a common git dir.
+            if os.path.isfile(git_dir):
+                with open(git_dir, "r") as f:
+                    line = f.readline()
+                if not line.startswith("gitdir:"):
+                    return None
+                git_dir = os.path.join(self.root_dir, line[7:].strip())
+            common_dir = os.path.join(git_dir, "commondir")
+            if os.path.isfile(common_dir):
+                with open(common_dir, "r") as f:
+                    git_dir = os.path.join(git_dir, f.readline().strip())
+            if os.path.exists(os.path.join(git_dir, "reftable")):
+                return None
+            branches = set()
+            heads_dir = os.path.join(git_dir, "refs", "heads")
+            for dir, _, names in os.walk(heads_dir):
+                for name in names:
+                    if not name.endswith(".lock"):
+                        branches.add(os.path.relpath(
+                            os.path.join(dir, name), heads_dir).replace(os.sep, "/"))
+            packed_refs = os.path.join(git_dir, "packed-refs")
+            if os.path.exists(packed_refs):
+                with open(packed_refs, "r") as f:
+                    for line in f:
+                        ref = line.rstrip("\n").partition(" ")[2]
+                        if ref.startswith("refs/heads/"):
+                            branches.add(ref[11:])
+            return branches
+        except OSError:
+            return None
 
     def make_empty_branch(self, branch, message):
         if not self.have_branch(branch):
@@ -367,29 +440,34 @@ a git repo to be initialized, and linked to a remote, ahead of time.\
             try:
                 self.exec(["git", "branch", "--quiet",
                           "barbarian", "origin/barbarian"])
+                self._branches = None
             except CalledProcessError:
                 pass
         if not self.have_branch(branch):
-            # Do a git dance to create a fresh truly detached branch.
+            # Create a fresh truly detached branch, with a single empty commit,
+            # directly from git objects. No worktree or checkout needed.
             print("[INFO] Creating local '{0}' branch.".format(
                 branch), flush=True)
-            cwd = getcwd()
-            try:
-                self.exec(["git", "worktree", "add", "--quiet", "-b",
-                           branch+"-tmp", os.path.join(cwd, "."+branch+".tmp")])
-            except CalledProcessError:
-                raise UsageError('''[ERROR] \
-Uploading requires the git repo to have a HEAD revision to create upload \
-branch.\
-''')
-            chdir(os.path.join(cwd, "."+branch+".tmp"))
-            self.exec(["git", "checkout", "--quiet", "--orphan", branch])
-            self.exec(["git", "rm", "--quiet", "-rf", "."])
-            self.exec(["git", "commit", "--allow-empty", "-m", message])
-            self.exec(["git", "branch", "--quiet", "-D", branch+"-tmp"])
-            chdir(cwd)
-            self.exec(["git", "worktree", "remove",
-                      os.path.join(cwd, "."+branch+".tmp")])
+            empty_tree = self.exec(
+                ["git", "mktree"], input="", capture_output=True).stdout.strip()
+            commit = self.exec(
+                ["git", "commit-tree", empty_tree, "-m", message],
+                capture_output=True).stdout.strip()
+            self.exec(["git", "branch", "--quiet", branch, commit])
+            self._branches = None
+
+    def uploaded_revision(self):
+        # The latest revision of the recipe pushed to the origin upload
+        # branch, read from its latest.json without checking it out.
+        latest = self.exec(
+            ["git", "cat-file", "--batch"],
+            input="origin/barbarian:%s/%s/latest.json\n" % (
+                *self.recipe_name_and_version,),
+            capture_output=True).stdout
+        header, _, content = latest.partition("\n")
+        if header.endswith(" missing"):
+            return None
+        return json.loads(content).get('revision')
 
     def make_barbarian_branch(self):
         self.make_empty_branch("barbarian", "Barbarian upload branch.")
@@ -400,46 +478,47 @@ branch.\
 
     bpt_package_reference = "git+https://github.com/bfgroup/bincrafters-package-tools@develop"
 
+    # Template fields, i.e. "<<<NAME>>>", to fill in.
+    _template_field_re = re.compile(r"<<<(\w+)>>>")
+
     def render_template(self, template, path):
-        text = template
-        text = text.replace(
-            "<<<USER>>>", self.recipe_user_and_channel[0])
-        text = text.replace(
-            "<<<GROUP>>>", self.recipe_user_and_channel[1])
-        text = text.replace(
-            "<<<NAME>>>", self._recipe_name_and_version[0])
-        text = text.replace(
-            "<<<VERSION>>>", self._recipe_name_and_version[1])
-        text = text.replace(
-            "<<<BPT_PACKAGE>>>", self.bpt_package_reference)
-        text = text.replace(
-            "<<<REMOTE_URL>>>", self.args.remote_url)
-        text = text.replace(
-            "<<<REMOTE_NAME>>>", self.args.remote_name)
+        # Fill in all the fields in one pass over the template. Fields we
+        # don't know about are left as they are.
+        fields = {
+            "USER": self.recipe_user_and_channel[0],
+            "GROUP": self.recipe_user_and_channel[1],
+            "NAME": self.recipe_name_and_version[0],
+            "VERSION": self.recipe_name_and_version[1],
+            "BPT_PACKAGE": self.bpt_package_reference,
+            "REMOTE_URL": self.args.remote_url,
+            "REMOTE_NAME": self.args.remote_name,
+        }
+        text = self._template_field_re.sub(
+            lambda m: fields.get(m.group(1), m.group(0)), template)
         with open(path, "w") as file:
             file.write(text)
 
     # Commands..
 
     def command_export(self, args):
-        # Compute state.
-        self.root_dir = args
-        self.recipe_data_dir = args
-        self.recipe_export_dir = args
-        self.recipe_name_and_version = args
-        self.recipe_user_and_channel = args
+        from shutil import rmtree
         # Info.
         print("[INFO] Exporting to %s" % (self.recipe_export_dir), flush=True)
         # Remove old data.
         rmtree(self.recipe_data_dir, ignore_errors=True)
         # Tweak gitignore to blank out temp conan data.
         gitignore_path = os.path.join(self.root_dir, ".gitignore")
-        gitignore = ""
-        if os.path.exists(gitignore_path):
-            gitignore = tools.load(gitignore_path)
-        if not '/.conan/' in gitignore:
-            gitignore = "/.conan/\n" + gitignore
-            tools.save(gitignore_path, gitignore)
+        # Any BOM is dropped, and bytes that aren't UTF-8 are kept as is.
+        try:
+            with open(gitignore_path, "r", encoding="utf-8-sig",
+                      errors="surrogateescape", newline="") as f:
+                gitignore = f.read()
+        except FileNotFoundError:
+            gitignore = ""
+        if '/.conan/' not in (line.strip() for line in gitignore.splitlines()):
+            with open(gitignore_path, "w", encoding="utf-8",
+                      errors="surrogateescape", newline="") as f:
+                f.write("/.conan/\n" + gitignore)
         # Enable needed hooks.
         self.conan_api.config_set('hooks.barbarian_clean_conandata_yml', "")
         # Do the basic export.
@@ -450,16 +529,97 @@ branch.\
             self.recipe_user_and_channel[0],
             self.recipe_user_and_channel[1])
 
+    def make_revision_dir(self, args, revision_dir, export_dir):
+        # Only uploading needs these, avoid loading them for other commands.
+        from concurrent.futures import ThreadPoolExecutor
+        from shutil import rmtree, copytree, copy
+        from threading import Thread
+        # Build the revision data in a staging dir and swap it into place
+        # when done. Any previous upload of the revision is moved aside
+        # and removed in the background meanwhile.
+        stage_dir = revision_dir + ".new"
+        stale_dir = revision_dir + ".old"
+        rmtree(stage_dir, ignore_errors=True)
+        rmtree(stale_dir, ignore_errors=True)
+        if os.path.exists(revision_dir):
+            os.replace(revision_dir, stale_dir)
+        cleanup = Thread(target=rmtree, args=(stale_dir,),
+                         kwargs={'ignore_errors': True})
+        cleanup.start()
+        try:
+            os.makedirs(stage_dir)
+            files_dir = os.path.join(stage_dir, "files")
+            # Copy export data. Only the contents matter to git, so by default
+            # hard link the files, or copy them without timestamps and other
+            # file metadata.
+            copytree(
+                export_dir, files_dir,
+                copy_function=copy if args.copy else _link_or_copy)
+            # Generate the conan_export.tgz, and the conan_sources.tgz. The
+            # archives are built side by side, as compressing releases the
+            # GIL, and digested as they are written.
+            conandata_yml = os.path.join(export_dir, "conandata.yml")
+            conan_export_tgz = os.path.join(files_dir, "conan_export.tgz")
+            export_source_dir = os.path.join(
+                self.recipe_export_dir, "export_source")
+            conan_sources_tgz = os.path.join(files_dir, "conan_sources.tgz")
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                export_digest = pool.submit(
+                    _make_tgz, conan_export_tgz,
+                    [(conandata_yml, os.path.basename(conandata_yml))]
+                    if os.path.exists(conandata_yml) else [])
+                sources_digest = pool.submit(
+                    _make_tgz, conan_sources_tgz,
+                    [(os.path.join(export_source_dir, source), source)
+                     for source in sorted(os.listdir(export_source_dir))])
+            digests = {
+                "conan_export.tgz": export_digest.result(),
+                "conan_sources.tgz": sources_digest.result()}
+            # Generate snapshot.json (v1), and files.json (v2).
+            # The remaining files are hashed concurrently, hashlib releases
+            # the GIL while digesting. There are only a handful of them so
+            # the pool is sized to match.
+            snapshot = {}
+            files = {'files': {}}
+            with os.scandir(files_dir) as it:
+                export_files = list(it)
+            to_hash = [f for f in export_files if f.name not in digests]
+            if to_hash:
+                with ThreadPoolExecutor(max_workers=min(8, len(to_hash))) as pool:
+                    digests.update(zip(
+                        [f.name for f in to_hash],
+                        pool.map(_md5_path, [f.path for f in to_hash])))
+            for export_file in export_files:
+                snapshot[export_file.name] = digests[export_file.name]
+                files['files'][export_file.name] = {
+                    'size': export_file.stat().st_size}
+            _write_json(os.path.join(stage_dir, "snapshot.json"), snapshot)
+            _write_json(os.path.join(stage_dir, "files.json"), files)
+            os.replace(stage_dir, revision_dir)
+        except BaseException:
+            # Don't leave the removal running on failure, the caller is about
+            # to remove the worktree it's in.
+            cleanup.join()
+            raise
+        # The stale data is removed in the background, the caller waits for
+        # it to finish.
+        return cleanup
+
+    def register_revision(self, name, version, revision):
+        # Fetch the exported data to "register" the new recipe revision with the server.
+        recipe_ref = "%s/%s@%s/%s#%s" % (
+            name, version, *self.recipe_user_and_channel, revision)
+        print("[INFO] Register recipe", recipe_ref, flush=True)
+        self.conan_api.get_path(
+            recipe_ref,
+            path="conan_export.tgz",
+            remote_name=self.args.remote_name)
+
     def command_upload(self, args):
-        # Compute state.
-        self.recipe_export_dir = args
-        self.recipe_exported_revision = args
-        self.recipe_publish_dir = args
-        self.recipe_revision_pub_dir = args
-        self.recipe_name_and_version = args
-        self.recipe_user_and_channel = args
+        revision = self.recipe_exported_revision
+        name, version = self.recipe_name_and_version
         print("[INFO] Uploading revision %s to %s" %
-              (self.recipe_exported_revision, self.recipe_publish_dir), flush=True)
+              (revision, self.recipe_publish_dir), flush=True)
         # Check prerequisites.
         try:
             self.exec(["git", "remote", "show", "origin"])
@@ -470,70 +630,51 @@ set a remote to push to with "git remote add origin <url>".\
 ''')
         # Checkout the upload branch.
         self.make_barbarian_branch()
+        # Skip the upload if this revision is already the latest one. But
+        # do register it, in case that failed after it was pushed.
+        if not args.force and self.uploaded_revision() == revision:
+            print("[INFO] Revision %s is already uploaded, skipping." %
+                  (revision), flush=True)
+            self.register_revision(name, version, revision)
+            return
         worktree_dir = os.path.join(self.root_dir, ".barbarian_upload")
         cwd = getcwd()
         self.exec(["git", "worktree", "add", worktree_dir, "barbarian"])
+        cleanup = None
         try:
-            # Remove old data.
-            rmtree(self.recipe_revision_pub_dir, ignore_errors=True)
-            os.makedirs(self.recipe_revision_pub_dir)
-            # Copy export data.
-            copytree(
-                os.path.join(self.recipe_export_dir, "export"),
-                os.path.join(self.recipe_revision_pub_dir, "files"))
-            # Generate the conan_export.tgz.
-            conandata_yml = os.path.join(
-                self.recipe_export_dir, "export", "conandata.yml")
-            conan_export_tgz = os.path.join(
-                self.recipe_revision_pub_dir, "files", "conan_export.tgz")
-            with tarfile.open(conan_export_tgz, 'w|gz') as tgz:
-                if os.path.exists(conandata_yml):
-                    tgz.add(conandata_yml, os.path.basename(conandata_yml))
-            # Generate the conan_sources.tgz.
-            export_source_dir = os.path.join(
-                self.recipe_export_dir, "export_source")
-            conan_sources_tgz = os.path.join(
-                self.recipe_revision_pub_dir, "files", "conan_sources.tgz")
-            with tarfile.open(conan_sources_tgz, 'w|gz') as tgz:
-                for source in os.listdir(export_source_dir):
-                    tgz.add(os.path.join(export_source_dir, source), source)
-            # Generate snapshot.json (v1), and files.json (v2).
-            snapshot = {}
-            files = {'files': {}}
-            for export_file in listdir(os.path.join(self.recipe_revision_pub_dir, "files")):
-                with open(os.path.join(self.recipe_revision_pub_dir, "files", export_file), "rb") as f:
-                    digest = hashlib.md5(f.read()).hexdigest()
-                    snapshot[export_file] = digest
-                    files['files'][export_file] = {}
-            with open(os.path.join(self.recipe_revision_pub_dir, "snapshot.json"), "w", encoding="utf-8") as f:
-                json.dump(snapshot, f)
-            with open(os.path.join(self.recipe_revision_pub_dir, "files.json"), "w", encoding="utf-8") as f:
-                json.dump(files, f)
-            # Update latest.json.
+            # A revision's contents are fixed by its hash. If it was uploaded
+            # before, and its files are still all there, it's used as is.
+            revision_dir = self.recipe_revision_pub_dir
+            export_dir = os.path.join(self.recipe_export_dir, "export")
+            if args.force or not _revision_matches(export_dir, revision_dir):
+                cleanup = self.make_revision_dir(args, revision_dir, export_dir)
+            else:
+                print("[INFO] Reusing uploaded data of revision %s." %
+                      (revision), flush=True)
+            # Update latest.json. The time is in UTC with microseconds, as
+            # it always has been.
+            now_ns = time.time_ns()
             latest = {
-                'revision': self.recipe_exported_revision,
-                'time': datetime.datetime.utcnow().isoformat()+"+0000"}
-            with open(os.path.join(self.recipe_publish_dir, "latest.json"), "w", encoding="utf-8") as f:
-                json.dump(latest, f)
-            # Commit changes.
+                'revision': revision,
+                'time': time.strftime(
+                    "%Y-%m-%dT%H:%M:%S", time.gmtime(now_ns // 1000000000))
+                + ".%06d+0000" % (now_ns // 1000 % 1000000)}
+            _write_json(os.path.join(
+                self.recipe_publish_dir, "latest.json"), latest)
+            # Commit changes, once the stale data is gone.
+            if cleanup:
+                cleanup.join()
             chdir(worktree_dir)
             self.exec(["git", "add", "."])
-            self.exec(["git", "status"])
             self.exec(["git", "commit", "-m", "Upload %s/%s revision %s." % (
-                self.recipe_name_and_version[0], self.recipe_name_and_version[1],
-                self.recipe_exported_revision)])
+                name, version, revision)])
             # Upload, aka push, the branch.
             self.push_barbarian_branch()
-            # Fetch the exported data to "register" the new recipe revision with the server.
-            recipe_ref = "%s/%s@%s/%s#%s" % (
-                *self.recipe_name_and_version, *self.recipe_user_and_channel, self.recipe_exported_revision)
-            print("[INFO] Register recipe", recipe_ref, flush=True)
-            conan_export_tgz = self.conan_api.get_path(
-                recipe_ref,
-                path="conan_export.tgz",
-                remote_name=self.args.remote_name)
+            self.register_revision(name, version, revision)
         finally:
-            # Clean up the upload tree.
+            # Clean up the upload tree, once nothing is removing from it.
+            if cleanup:
+                cleanup.join()
             chdir(cwd)
             self.exec(["git", "worktree", "remove", "-f", worktree_dir])
 
@@ -543,11 +684,36 @@ set a remote to push to with "git remote add origin <url>".\
         elif args.action == "push":
             self.push_barbarian_branch()
 
+    def command_batch(self, args):
+        import shlex
+        # Run each of the listed commands in this process, one per line, so
+        # that Conan, and the rest, is loaded and set up only once.
+        if args.file == "-":
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(args.file, "r") as f:
+                lines = f.read().splitlines()
+        # On Windows backslashes are path separators, not escapes, so split
+        # the lines the non-POSIX way and just drop the quotes around args.
+        posix = os.name != "nt"
+        for line in lines:
+            argv = shlex.split(line, comments=True, posix=posix)
+            if not posix:
+                argv = [arg[1:-1] if len(arg) > 1 and arg[0] == arg[-1]
+                        and arg[0] in "\"'" else arg for arg in argv]
+            if not argv:
+                continue
+            batch_args = _parse_args(["--remote=" + args.remote] + argv)
+            if batch_args.command not in _commands or batch_args.command == "batch":
+                raise UsageError('''[ERROR] \
+Invalid batch command "{0}". Each line of a batch needs to be one of the \
+export, upload, branch, or new commands.\
+'''.format(line))
+            print("[INFO] Batch command:", line, flush=True)
+            _commands[batch_args.command](Barbarian(batch_args), batch_args)
+
     def command_new(self, args):
-        # Compute state.
-        self.root_dir = args
-        self.recipe_name_and_version = args
-        self.recipe_user_and_channel = args
+        import yaml
         # While config files to generate.
         to_generate = set()
         if args.recipe:
@@ -564,7 +730,7 @@ set a remote to push to with "git remote add origin <url>".\
                 package_dir = self.root_dir
             elif args.recipe == "collection":
                 package_dir = os.path.join(
-                    self.root_dir, "recipes", self._recipe_name_and_version[0], "all")
+                    self.root_dir, "recipes", self.recipe_name_and_version[0], "all")
             conanfile_py_path = os.path.join(package_dir, "conanfile.py")
             if os.path.exists(conanfile_py_path) and not args.overwrite:
                 print("[INFO] Skipped overwrite of existing recipe %s" %
@@ -762,23 +928,172 @@ class CollectArgAction(Action):
         super().__init__(option_strings, dest, default=default, **kwargs)
 
     def __call__(self, parser, namespace, values, option_string=None):
-        dest = getattr(namespace, self.dest)
-        dest.add(values)
-        setattr(namespace, self.dest, dest)
+        # The set is updated in place, no need to set it again.
+        getattr(namespace, self.dest).add(values)
 
 
 class ChoiceArgAction(Action):
     def __init__(self, option_strings, dest, default=None, nargs=None, **kwargs):
         super().__init__(option_strings, dest, nargs="?", **kwargs)
         self.flag_default = default
+        # The value to use when the option is given without one.
+        self.first_choice = self.choices[0] if self.choices else None
 
     def __call__(self, parser, namespace, values, option_string=None):
-        values = self.choices[0] if not values else values
-        setattr(namespace, self.dest, values)
+        setattr(namespace, self.dest, values or self.first_choice)
+
+
+def _add_export_parser(ap_sub):
+    # Export command..
+    ap_export = ap_sub.add_parser(
+        "export",
+        help="Copies the recipe (conanfile.py & associated files) to local repo cache."
+    )
+    ap_export.add_argument(
+        "path",
+        help="Path to a folder containing a conanfile.py or to a recipe file e.g., my_folder/conanfile.py")
+    ap_export.add_argument(
+        "reference",
+        help="Pkg/version@user/channel"
+    )
+
+
+def _add_upload_parser(ap_sub):
+    # Upload command..
+    ap_upload = ap_sub.add_parser(
+        "upload",
+        help="Copies the current exported recipe to the local publish location."
+    )
+    ap_upload.add_argument(
+        "reference",
+        help="Pkg/version@user/channel"
+    )
+    ap_upload.add_argument(
+        "--copy",
+        help="Copy the exported files instead of hard linking them.",
+        action="store_true")
+    ap_upload.add_argument(
+        "--force",
+        help="Upload even if the revision is already the latest uploaded one.",
+        action="store_true")
+
+
+def _add_branch_parser(ap_sub):
+    # Upload branch..
+    ap_branch = ap_sub.add_parser(
+        "branch",
+        help="Create, if needed, the 'barbarian' branch for uploading exported recipes to.")
+    ap_branch.add_argument(
+        "action",
+        help="What action to apply to the upload branch.",
+        choices=['create', 'push']
+    )
+
+
+def _add_new_parser(ap_sub):
+    # Create new recipe and/or other support files.
+    ap_new = ap_sub.add_parser(
+        "new",
+        help="Creates a new package recipe template and/or support files.")
+    ap_new.add_argument(
+        "reference",
+        help="name/version@user/channel")
+    ap_new.add_argument(
+        "--overwrite",
+        help="Overwrite existing files, if present, with new files.",
+        action="store_true")
+    ap_new.add_argument(
+        "--recipe",
+        help="The style of package recipe to generate, and flag to generate recipe.",
+        choices=['standalone', 'collection'],
+        action=ChoiceArgAction)
+    ap_new.add_argument(
+        "--header-only",
+        help="Create a header only package recipe.",
+        action="store_true")
+    ap_new.add_argument(
+        "--ci",
+        help="Create setup, i.e. scripts, for testing in CI for the given service.",
+        choices=["github"],
+        action=ChoiceArgAction)
+
+
+def _add_batch_parser(ap_sub):
+    # Run many commands in one go.
+    ap_batch = ap_sub.add_parser(
+        "batch",
+        help="Runs the commands listed in a file, one per line, sharing the setup between them.")
+    ap_batch.add_argument(
+        "file",
+        help="File with the commands to run, or '-' to read them from stdin.")
+
+
+_subcommand_parsers = {
+    "export": _add_export_parser,
+    "upload": _add_upload_parser,
+    "branch": _add_branch_parser,
+    "new": _add_new_parser,
+    "batch": _add_batch_parser,
+}
+
+
+@lru_cache(maxsize=None)
+def _build_parser(command=None):
+    # The parser is built once, on first use, and reused after. When the
+    # command is known only its sub-command parser is added, otherwise all
+    # of them are.
+    ap = ArgumentParser("barbarian")
+
+    # General options..
+    ap.add_argument(
+        "--version",
+        help="Show the installed version.",
+        action="version",
+        version='%(prog)s ' + (version('barbarian')))
+    ap.add_argument(
+        "--remote",
+        help="The remote Barbarian repo to use specified as `<URL>@<NAME>."
+        + " Defaults to `https://barbarian.bfgroup.xyz/github@barbarian-github`.",
+        default="https://barbarian.bfgroup.xyz/github@barbarian-github"
+    )
+
+    # Sub-commands..
+    ap_sub = ap.add_subparsers(dest="command")
+    for name, add_parser in _subcommand_parsers.items():
+        if command is None or command == name:
+            add_parser(ap_sub)
+
+    return ap
+
+
+def _parse_args(argv):
+    # Guess the command from the first positional argument. Anything that
+    # isn't clearly a single command, including asking for help, gets the
+    # full parser.
+    command = next((arg for arg in argv if not arg.startswith('-')), None)
+    if command not in _subcommand_parsers or '-h' in argv or '--help' in argv:
+        command = None
+    return _build_parser(command).parse_args(argv)
+
+
+# The commands, as run on a Barbarian, for each sub-command.
+_commands = {
+    "export": Barbarian.command_export,
+    "upload": Barbarian.command_upload,
+    "branch": Barbarian.command_branch,
+    "new": Barbarian.command_new,
+    "batch": Barbarian.command_batch,
+}
 
 
 def main():
-    Barbarian()
+    args = _parse_args(sys.argv[1:])
+    if args.command in _commands:
+        try:
+            _commands[args.command](Barbarian(args), args)
+        except UsageError as error:
+            print(fg.red + error.reason + fg.rs)
+            exit(1)
 
 
 if __name__ == '__main__':
@@ -8,23 +8,44 @@ Hook to clean the conandata.yml information for Barbarian style packages.
 
 import os.path
 import yaml
-import conans.tools
+
+# Parse with libyaml when PyYAML was built with it, it's much faster.
+try:
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
 
 
 def post_export(output, conanfile, conanfile_path, reference, **args):
     conandata_yml_path = os.path.join(
         os.path.dirname(conanfile_path), "conandata.yml")
-    if not os.path.exists(conandata_yml_path):
+    try:
+        st = os.stat(conandata_yml_path)
+    except FileNotFoundError:
         return
-    conandata_yml_in = yaml.safe_load(conans.tools.load(conandata_yml_path))
+    # The loader decodes the raw bytes itself.
+    with open(conandata_yml_path, "rb") as f:
+        conandata_yml_in = yaml.load(f.read(), Loader=_Loader)
+    # An empty document has nothing to keep.
+    if conandata_yml_in is None:
+        conandata_yml_in = {}
     conandata_yml_out = {}
     # Filter the data to only keep the sections and subkeys that match the
-    # exported version.
+    # exported version. Sections that aren't keyed by version are dropped.
     version = str(conanfile.version)
-    for section in conandata_yml_in:
-        if version in conandata_yml_in[section]:
-            conandata_yml_out[section] = {
-                version: conandata_yml_in[section][version]
-            }
-    # Overwrite out the conandata.yml with the updated info.
-    conans.tools.save(conandata_yml_path, yaml.safe_dump(conandata_yml_out))
+    for section, entries in conandata_yml_in.items():
+        if isinstance(entries, dict) and version in entries:
+            conandata_yml_out[section] = {version: entries[version]}
+    # Overwrite out the conandata.yml with the updated info, unless it
+    # already is exactly that. It's written to the side and moved into
+    # place, so it's never left half written.
+    conandata_yml = yaml.safe_dump(conandata_yml_out).encode("utf-8")
+    unchanged = False
+    if len(conandata_yml) == st.st_size:
+        with open(conandata_yml_path, "rb") as f:
+            unchanged = f.read() == conandata_yml
+    if not unchanged:
+        conandata_yml_tmp = conandata_yml_path + ".tmp"
+        with open(conandata_yml_tmp, "wb") as f:
+            f.write(conandata_yml)
+        os.replace(conandata_yml_tmp, conandata_yml_path)